@@ -1,9 +1,9 @@
 import argparse
 import logging
 import os
-import sys
 from glob import glob
 from pathlib import Path
+from typing import Optional
 
 import tmdbsimple as tmdb
 from prompt_toolkit.shortcuts import yes_no_dialog
@@ -12,6 +12,22 @@ from . import common, movies, shows
 from .filters import Filters
 
 
+RECURSIVE_MKV = "**/*.mkv"
+FLAT_MKV = "*.mkv"
+
+
+def literal_dir(pattern: str, suffix: str) -> Optional[Path]:
+    """Directory a pattern like "<dir>/<suffix>" scans, if <dir> has no glob magic"""
+    if not pattern.endswith(suffix):
+        return None
+    directory = pattern[: -len(suffix)]
+    if directory and not directory.endswith("/"):
+        return None
+    if any(c in directory for c in "*?["):
+        return None
+    return Path(directory or ".")
+
+
 def make_filters(args):
     filters = Filters()
     if args.filter_lang:
@@ -23,30 +39,47 @@ def movie_logic(args):
     paths = []
     filters = make_filters(args)
     for pattern in args.files:
-        if "*" not in pattern and pattern.endswith("/"):
-            pattern += "*.mkv"
-        paths.extend(glob(pattern, recursive=True))
-
-    for filename in paths:
-        res = movies.process_movie_file(
-            args.output, args.format, Path(filename), filters=filters
-        )
-        if res is None:
-            print(f"Failed processing file: {filename}")
-            continue
-
-        if res.approved:
-            common.rename_file(res, args.dry_run)
-        elif yes_no_dialog(
-            text=f"Sure you want to delete?\n{res.src}",
-        ).run():
-            res.src.unlink()
-
-        try:
-            if not args.dry_run:
-                res.src.parent.rmdir()
-        except:
-            pass
+        if pattern.endswith("/"):
+            pattern += FLAT_MKV
+        # Plain directories don't need glob's pattern matching, scan them directly
+        if (directory := literal_dir(pattern, RECURSIVE_MKV)) is not None:
+            paths.extend(common.scan_files(directory, (".mkv",), recursive=True))
+        elif (directory := literal_dir(pattern, FLAT_MKV)) is not None:
+            paths.extend(common.scan_files(directory, (".mkv",)))
+        else:
+            paths.extend(Path(x) for x in glob(pattern, recursive=True))
+
+    source_dirs = set()
+    try:
+        for filename in movies.prefetch_matches(
+            paths, filters=filters, guess_from_dirname=args.guess_from_dirname
+        ):
+            res = movies.process_movie_file(
+                args.output,
+                args.format,
+                filename,
+                filters=filters,
+                guess_from_dirname=args.guess_from_dirname,
+            )
+            if res is None:
+                print(f"Failed processing file: {filename}")
+                continue
+
+            if res.approved:
+                common.rename_file(res, args.dry_run)
+            elif yes_no_dialog(
+                text=f"Sure you want to delete?\n{res.src}",
+            ).run():
+                res.src.unlink()
+            source_dirs.add(res.src.parent)
+    finally:
+        # Remove emptied rip folders once at the end rather than after every file
+        if not args.dry_run:
+            for folder in source_dirs:
+                try:
+                    folder.rmdir()
+                except OSError:
+                    pass
 
 
 def tv_logic(args):
@@ -71,6 +104,11 @@ def movie_argparser(movies_p: argparse.ArgumentParser):
         type=Path,
         help="Should be jellyfin movies dir",
     )
+    movies_p.add_argument(
+        "--guess-from-dirname",
+        action="store_true",
+        help="Don't read embedded titles, search by the parent directory name instead",
+    )
     movies_p.add_argument(
         "files",
         nargs="+",
@@ -147,6 +185,8 @@ def main():
         logging.error("No API key provided")
         return -1
 
+    tmdb.REQUESTS_SESSION = common.make_session()
+
     try:
         if args.cmd == "movies":
             movie_logic(args)
@@ -1,28 +1,68 @@
+import errno
+import functools
+import json
+import os
+import re
 import shutil
+import subprocess
 import logging
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Any, List, Optional, Sequence, Set, Tuple
 
-import prompt_toolkit as pt
-from pymkv import MKVFile
+import requests
+from prompt_toolkit.shortcuts import radiolist_dialog
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+# One pass instead of replacing "- blu-ray" then "blu-ray". The two only differ on
+# contrived overlapping input where the first removal creates a new match
+_BLU_RAY_RE = re.compile(r"(?:- )?blu-ray")
 
-@dataclass
+
+@dataclass(frozen=True, slots=True)
 class ProcessedFile:
     src: Path
     dst: Path
     approved: bool
 
 
+@dataclass
+class MKVInfo:
+    """Identification output of `mkvmerge -J` for a single file"""
+    info_json: dict
+
+    @property
+    def title(self) -> Optional[str]:
+        return self.info_json["container"].get("properties", {}).get("title")
+
+
+def cache_dir() -> Path:
+    """Directory for persistent caches, following the XDG base directory spec"""
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "jellyname"
+
+
+def make_session() -> requests.Session:
+    """HTTP session so TMDB calls reuse connections, retrying rate limits and server errors"""
+    session = requests.Session()
+    retries = Retry(
+        total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504]
+    )
+    session.mount(
+        "https://",
+        HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries),
+    )
+    return session
+
+
 def fix_title(title: str):
     """Fixup small inconsistent naming patterns"""
     title = title.lower()
     if title.endswith(", the"):
         title = "the " + title[:-5]
 
-    title = title.replace("- blu-ray", "")
-    title = title.replace("blu-ray", "")
-    return title
+    return _BLU_RAY_RE.sub("", title)
 
 
 def guess_title(filename: Path):
@@ -31,8 +71,55 @@ def guess_title(filename: Path):
     return cleaned
 
 
-def guess_mkv_format(movie: MKVFile):
-    video_tracks = [x for x in movie._info_json["tracks"] if x["type"] == "video"]
+def scan_files(
+    directory: Path,
+    suffixes: Tuple[str, ...],
+    recursive: bool = False,
+    include_hidden: bool = False,
+) -> List[Path]:
+    """List files ending in one of suffixes with a single os.scandir pass per directory.
+    Missing directories are empty. Hidden entries are skipped like glob.glob does, unless
+    include_hidden is set to match Path.glob.
+    """
+    found = []
+    stack = [os.fspath(directory)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if not include_hidden and entry.name.startswith("."):
+                        continue
+                    if recursive and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(suffixes) and entry.is_file():
+                        found.append(Path(entry.path))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+    return found
+
+
+def count_files(directory: Path, suffixes: Tuple[str, ...]) -> int:
+    """Count entries ending in one of suffixes without building a list.
+    Hidden entries are counted too, like Path.glob.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return sum(1 for e in it if e.name.endswith(suffixes))
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+
+
+@functools.lru_cache(maxsize=None)
+def load_mkv(filename: Path) -> MKVInfo:
+    """Identify a file with a single mkvmerge call, later calls reuse the result"""
+    out = subprocess.run(
+        ["mkvmerge", "-J", os.fspath(filename)], capture_output=True, check=True
+    ).stdout
+    return MKVInfo(info_json=json.loads(out))
+
+
+def guess_mkv_format(movie: MKVInfo):
+    video_tracks = [x for x in movie.info_json["tracks"] if x["type"] == "video"]
     if not video_tracks:
         return None
     _, horizontal = video_tracks[0]["properties"]["pixel_dimensions"].split("x")
@@ -41,22 +128,51 @@ def guess_mkv_format(movie: MKVFile):
     return None
 
 
+# Destination folders already made this session, most batches reuse the same few
+_created_dirs: Set[Path] = set()
+
+
 def rename_file(op: ProcessedFile, dry_run: bool = False):
     if not op.approved:
         return
     logging.info(f"mv {op.src} -> {op.dst}")
     if not dry_run:
+        move_file(op)
+
+
+def move_file(op: ProcessedFile):
+    """Move op.src to op.dst without logging, for callers that log the move themselves"""
+    if op.dst.parent not in _created_dirs:
         op.dst.parent.mkdir(parents=True, exist_ok=True)
+        _created_dirs.add(op.dst.parent)
+    try:
+        os.replace(op.src, op.dst)
+    except OSError as e:
+        # Only fall back to a full copy when crossing filesystems
+        if e.errno != errno.EXDEV:
+            raise
         shutil.move(op.src, op.dst)
 
 
-def prompt_continue(prompt_str: str) -> bool:
+def paged_radiolist_dialog(
+    title: str,
+    text: str,
+    values: Sequence[Tuple[Any, str]],
+    extra: Sequence[Tuple[Any, str]] = (),
+    page_size: int = 40,
+) -> Any:
+    """radiolist_dialog that shows long lists a page at a time, since they render slowly.
+    The extra values (e.g. "None of the above") are shown on every page.
+    """
+    PAGE = object()
+    start = 0
     while True:
-        try:
-            resp = pt.prompt(prompt_str).lower()
-            if resp == "y":
-                return True
-            if resp == "n":
-                return False
-        except KeyboardInterrupt:
-            return False
+        page = list(values[start : start + page_size])
+        more = start + page_size < len(values)
+        if start or more:
+            page.append((PAGE, "More..." if more else "Back to the first page"))
+        page.extend(extra)
+        result = radiolist_dialog(title=title, text=text, values=page).run()
+        if result is not PAGE:
+            return result
+        start = start + page_size if more else 0
@@ -1,96 +1,189 @@
 import logging
+import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 
-import tmdbsimple as tmdb
 from prompt_toolkit.shortcuts import button_dialog, input_dialog, radiolist_dialog
-from pymkv import MKVFile
 
-from .common import ProcessedFile, fix_title, guess_title
+from .common import ProcessedFile, count_files, fix_title, guess_title, load_mkv
 from .filters import DefaultFilters, Filters
+from .tmdb_cache import cached_search
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Movie:
     title: str
     year: str
-    tmdb_id: str
+    tmdb_id: int
 
     def __str__(self):
         return f"{self.title} ({self.year}) [tmdb-{self.tmdb_id}]"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProcessedMovieFile(ProcessedFile):
     movie: Movie
 
 
+_YEAR_RE = re.compile(r"\b(?:19|20)\d{2}\b")
+
+# Filled by prefetch_matches ahead of the interactive prompts, one future per query so
+# files sharing a title only search once
+_prefetched_searches: Dict[str, Future] = {}
+_prefetch_lock = threading.Lock()
+
+
+def search_movies(query: str, lang: Optional[str] = None) -> List[dict]:
+    """Search TMDB for movies, preferring results that were already prefetched"""
+    future = _prefetched_searches.get(query)
+    if future is not None and future.exception() is None:
+        return future.result()
+    return cached_search(query, lang)
+
+
+def read_title(filename: Path, guess_from_dirname: bool = False) -> Optional[str]:
+    """Get the embedded title of a file, cleaned up for searching.
+    mkvmerge isn't run at all when the title is going to be guessed from the directory.
+    """
+    if guess_from_dirname or filename.suffix.lower() != ".mkv":
+        return None
+    title = load_mkv(filename).title
+    return fix_title(title) if title else None
+
+
+def _prefetch_one(filename: Path, lang: Optional[str], guess_from_dirname: bool):
+    query = read_title(filename, guess_from_dirname)
+    if not query:
+        return
+    with _prefetch_lock:
+        if query in _prefetched_searches:
+            return
+        future = _prefetched_searches[query] = Future()
+    try:
+        future.set_result(cached_search(query, lang))
+    except Exception as e:
+        future.set_exception(e)
+        raise
+
+
+def prefetch_matches(
+    paths: Iterable[Path],
+    filters: Filters = DefaultFilters,
+    guess_from_dirname: bool = False,
+    ahead: int = 4,
+) -> Iterator[Path]:
+    """Yield paths in order while the next few are parsed and searched in the background.
+    This hides mkvmerge and TMDB latency behind the time spent answering prompts. It is
+    best effort, anything that fails here is retried when the file is processed.
+    """
+    pool = ThreadPoolExecutor(max_workers=ahead)
+    pending = deque()
+    try:
+        for path in paths:
+            pending.append((path, pool.submit(_prefetch_one, path, filters.lang, guess_from_dirname)))
+            if len(pending) > ahead:
+                yield _wait_prefetch(*pending.popleft())
+        while pending:
+            yield _wait_prefetch(*pending.popleft())
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _wait_prefetch(path: Path, future) -> Path:
+    if future.exception() is not None:
+        logging.warning(f"Prefetch failed for {path}: {future.exception()}")
+    return path
+
+
+def rank_results(results: List[dict], search_term: str, limit: int = 10) -> List[dict]:
+    """Order search results so the likely match comes first, keeping only the top few.
+    Results released in a year mentioned by the search come first, then by popularity.
+    """
+    year = _YEAR_RE.search(search_term)
+    year = year.group(0) if year else None
+
+    def key(s):
+        same_year = year is not None and (s.get("release_date") or "").startswith(year)
+        return (not same_year, -s.get("popularity", 0.0))
+
+    return sorted(results, key=key)[:limit]
+
+
 def find_match(
-    movie: MKVFile, filename: Path, manual: bool = False, filters=DefaultFilters
+    title: Optional[str], filename: Path, manual: bool = False, filters=DefaultFilters
 ) -> Optional[Movie]:
-    search_term = movie.title
-    if movie.title is None or manual:
-        default_text = ""
-        if movie.title:
-            query_text = (
-                f"Title: {movie.title}\nFile: {filename}\nEnter search criteria:"
-            )
-            default_text = movie.title
-        else:
-            query_text = f"No title for\n{filename}\nEnter search criteria:"
-            default_text = guess_title(filename)
-        maybe = input_dialog(
-            title="Search",
-            text=query_text,
-            ok_text="Enter",
-            cancel_text="Skip",
-            default=default_text,
-        ).run()
-        if maybe is None:
-            return None
-        search_term = maybe
-
-    search = tmdb.Search()
-    search.movie(query=search_term)
-
-    if not search.results:
-        if movie.title and manual:
-            return None
-        logging.warning("Title did not find results, try manual")
-        return find_match(movie, filename, True)
-
-    movies = []
-    for s in search.results:
-        if (
-            filters.lang
-            and "original_language" in s
-            and s["original_language"].lower() != filters.lang
-        ):
+    NONEABOVE = object()
+    filename_str = os.fspath(filename)
+    while True:
+        search_term = title
+        if title is None or manual:
+            default_text = ""
+            if title:
+                query_text = f"Title: {title}\nFile: {filename_str}\nEnter search criteria:"
+                default_text = title
+            else:
+                query_text = f"No title for\n{filename_str}\nEnter search criteria:"
+                default_text = guess_title(filename)
+            maybe = input_dialog(
+                title="Search",
+                text=query_text,
+                ok_text="Enter",
+                cancel_text="Skip",
+                default=default_text,
+            ).run()
+            if maybe is None:
+                return None
+            search_term = maybe
+
+        results = search_movies(search_term, filters.lang)
+
+        if not results:
+            if title and manual:
+                return None
+            logging.warning("Title did not find results, try manual")
+            manual = True
             continue
 
-        year = s.get("release_date", "...").split("-")[0]
-        movies.append(
-            Movie(
+        candidates = []
+        seen = set()
+        filter_lang = filters.lang
+        for s in results:
+            # TMDB can return the same movie more than once
+            if s["id"] in seen:
+                continue
+            seen.add(s["id"])
+            if filter_lang:
+                lang = s.get("original_language")
+                if lang is not None and lang.lower() != filter_lang:
+                    continue
+            candidates.append(s)
+
+        values = []
+        for s in rank_results(candidates, search_term):
+            year = s.get("release_date", "...").split("-")[0]
+            movie = Movie(
                 title=s["title"],
                 year=year,
                 tmdb_id=s["id"],
             )
-        )
-
-    NONEABOVE = object()
-    result = radiolist_dialog(
-        title="Best Match",
-        text=str(filename),
-        values=[(x, str(x)) for x in movies] + [(NONEABOVE, "None of the above")],
-    ).run()
+            values.append((movie, str(movie)))
+        values.append((NONEABOVE, "None of the above"))
 
-    if result is NONEABOVE:
-        return find_match(movie, filename, True)
-    if result is None:
-        return None
+        result = radiolist_dialog(
+            title="Best Match",
+            text=filename_str,
+            values=values,
+        ).run()
 
-    return result
+        if result is NONEABOVE:
+            manual = True
+            continue
+        return result
 
 
 def process_movie_file(
@@ -98,28 +191,29 @@ def process_movie_file(
     out_format: str,
     filename: Path,
     filters: Filters = DefaultFilters,
+    guess_from_dirname: bool = False,
 ) -> ProcessedMovieFile:
-    file = MKVFile(filename)
-    if not file.title:
+    title = read_title(filename, guess_from_dirname)
+    if not title and not guess_from_dirname:
         logging.warning(f"No title in {filename}")
-    else:
-        file.title = fix_title(file.title)
 
-    match = find_match(file, filename, filters=filters)
+    match = find_match(title, filename, filters=filters)
     if match is None:
         logging.warning(f"No match for file: {filename}")
         return
 
-    default_tag = ""
-    maybe_dst = output_dir / out_format.format(
+    suffix = filename.suffix
+    fields = dict(
         title=match.title,
         year=match.year,
-        tag="",
         tmdb_id=match.tmdb_id,
-        ext=filename.suffix[1:],
+        ext=suffix[1:],
     )
-    if maybe_dst.exists():
-        default_tag = f"CD{len(list(maybe_dst.parent.glob(f'*{filename.suffix}')))}"
+    dst = output_dir / out_format.format(tag="", **fields)
+    exists = dst.exists()
+    default_tag = ""
+    if exists:
+        default_tag = f"CD{count_files(dst.parent, (suffix,))}"
 
     tag = input_dialog(
         title="Optional Tag",
@@ -128,22 +222,14 @@ def process_movie_file(
         cancel_text="Skip",
     ).run()
     if tag:
-        tag = f" - {tag}"
-    else:
-        tag = ""
+        # Without a tag the untagged path and its exists() check are still valid
+        dst = output_dir / out_format.format(tag=f" - {tag}", **fields)
+        exists = dst.exists()
 
     src = filename
-    dst = output_dir / out_format.format(
-        title=match.title,
-        year=match.year,
-        tag=tag,
-        tmdb_id=match.tmdb_id,
-        ext=src.suffix[1:],
-    )
-
     approved = button_dialog(
         title=match.title,
-        text=f"src: {src}\ndst: {dst}" + (" (exists)" if dst.exists() else ""),
+        text=f"src: {src}\ndst: {dst}" + (" (exists)" if exists else ""),
         buttons=[("Yes", True), ("Skip", None), ("Delete", False)],
     ).run()
     if approved is None:
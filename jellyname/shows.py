@@ -1,153 +1,227 @@
-import itertools
+import functools
+import json
 import logging
-from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
-import tmdbsimple as tmdb
-from prompt_toolkit.shortcuts import button_dialog, input_dialog, radiolist_dialog
-from pymkv import MKVFile
+import requests
+from prompt_toolkit.shortcuts import button_dialog, input_dialog
 
-from .common import ProcessedFile, guess_title, rename_file
+from .common import (
+    ProcessedFile,
+    cache_dir,
+    count_files,
+    guess_title,
+    load_mkv,
+    paged_radiolist_dialog,
+    move_file,
+    scan_files,
+)
+from .tmdb_cache import cached_season_info, cached_tv_info, cached_tv_search
 
 
-@dataclass
+# The labels below are built once, they are shown in dialogs that can redraw often
+
+
+@dataclass(frozen=True, slots=True)
 class TVSeason:
     name: str
     season_number: int
     episode_count: int
     year: str
     tmdb_id: int
+    _label: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        label = f"{self.name} Season {self.season_number} ({self.episode_count} episodes)"
+        object.__setattr__(self, "_label", label)
 
     def __str__(self):
-        return (
-            f"{self.name} Season {self.season_number} ({self.episode_count} episodes)"
-        )
+        return self._label
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class TVShow:
     name: str
-    seasons: TVSeason
+    seasons: Tuple[TVSeason, ...]
     episodes: int
     tmdb_id: int
     first_year: str
     last_year: str
+    _label: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        label = f"{self.name} ({self.first_year}-{self.last_year}) [tmdbid-{self.tmdb_id}]"
+        object.__setattr__(self, "_label", label)
 
     def __str__(self):
-        return f"{self.name} ({self.first_year}-{self.last_year}) [tmdbid-{self.tmdb_id}]"
+        return self._label
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class ProcessedTvFile(ProcessedFile):
     show: TVShow
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class TVEpisode:
     name: str
     episode_number: int
     air_date: str
     overview: str
     tmdb_id: int
+    _label: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "_label", f"S{self.episode_number:02} - {self.name}")
 
     def __str__(self):
-        return f"S{self.episode_number:02} - {self.name}"
+        return self._label
 
 
-def identify_tv_show(filename: Path, title=None, manual=False) -> Optional[TVShow]:
-    search_term = title
-    if title is None or manual:
-        default_text = ""
-        if title:
-            query_text = f"Title: {title}\nFile: {filename}\nEnter search criteria:"
-            default_text = title
-        else:
-            query_text = f"No title for\n{filename}\nEnter search criteria:"
-            default_text = guess_title(filename)
-        maybe = input_dialog(
-            title="Search",
-            text=query_text,
-            ok_text="Enter",
-            cancel_text="Skip",
-            default=default_text,
-        ).run()
-        if maybe is None:
-            return None
-        search_term = maybe
-
-    search = tmdb.Search()
-    search.tv(query=search_term)
-
-    if not search.results:
-        if title and manual:
-            return None
-        logging.warning("Title did not find results, try manual")
-        return identify_tv_show(filename, title, True)
-
-    shows = []
-    for s in search.results:
-        info = tmdb.TV(s["id"]).info()
-        first_year = info.get("first_air_date", "...").split("-")[0]
-        first_year = "..." if first_year is None else first_year.split("-")[0]
-        last_year = info.get("last_air_date")
-        last_year = "..." if last_year is None else last_year.split("-")[0]
-        seasons = []
-        for season in info["seasons"]:
-            air_date = season["air_date"]
-            seasons.append(
-                TVSeason(
-                    name=season["name"],
-                    season_number=season["season_number"],
-                    episode_count=season["episode_count"],
-                    year=air_date.split("-")[0] if air_date is not None else "N/A",
-                    tmdb_id=season["id"],
-                )
-            )
-        shows.append(
-            TVShow(
-                name=s["name"],
-                seasons=seasons,
-                episodes=info.get("number_of_episodes", 0),
-                first_year=first_year,
-                last_year=last_year,
-                tmdb_id=s["id"],
+def _recent_shows_file() -> Path:
+    return cache_dir() / "recent_shows.json"
+
+
+def load_recent_shows() -> Dict[str, dict]:
+    """Shows previously picked, keyed by the title or directory they were picked for"""
+    try:
+        shows = json.loads(_recent_shows_file().read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+    return shows if isinstance(shows, dict) else {}
+
+
+def remember_show(key: str, tv_show: TVShow):
+    # Only the id is kept, details are rebuilt from the TMDB cache so they expire with it
+    shows = load_recent_shows()
+    shows[key] = {"tmdb_id": tv_show.tmdb_id, "name": tv_show.name}
+    path = _recent_shows_file()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(shows))
+
+
+def recent_show(key: str) -> Optional[TVShow]:
+    data = load_recent_shows().get(key)
+    try:
+        return build_tv_show(data["tmdb_id"], data["name"], cached_tv_info(data["tmdb_id"]))
+    except (KeyError, TypeError, requests.HTTPError):
+        # Missing, stale or hand-edited entry, search as usual
+        return None
+
+
+def build_tv_show(tmdb_id: int, name: str, info: dict) -> TVShow:
+    """TVShow from the details returned by cached_tv_info"""
+    first_year = info.get("first_air_date")
+    first_year = "..." if first_year is None else first_year.split("-")[0]
+    last_year = info.get("last_air_date")
+    last_year = "..." if last_year is None else last_year.split("-")[0]
+    seasons = []
+    for season in info["seasons"]:
+        air_date = season["air_date"]
+        seasons.append(
+            TVSeason(
+                name=season["name"],
+                season_number=season["season_number"],
+                episode_count=season["episode_count"],
+                year=air_date.split("-")[0] if air_date is not None else "N/A",
+                tmdb_id=season["id"],
             )
         )
+    return TVShow(
+        name=name,
+        seasons=tuple(seasons),
+        episodes=info.get("number_of_episodes", 0),
+        first_year=first_year,
+        last_year=last_year,
+        tmdb_id=tmdb_id,
+    )
+
+
+def identify_tv_show(filename: Path, title=None, manual=False) -> Optional[TVShow]:
+    key = title or guess_title(filename)
+    if not manual:
+        # Skip searching TMDB for shows that were already picked for the same title
+        recent = recent_show(key)
+        if recent is not None and button_dialog(
+            title="Recent match",
+            text=f"File: {filename}\nUse {recent}?",
+            buttons=[("Yes", True), ("No", False)],
+        ).run():
+            return recent
 
     NONEABOVE = object()
-    result = radiolist_dialog(
-        title="Best Match",
-        text=str(filename),
-        values=[(x, str(x)) for x in shows] + [(NONEABOVE, "None of the above")],
-    ).run()
-
-    if result is NONEABOVE:
-        return identify_tv_show(filename, title, True)
-    if result is None:
-        return None
-    return result
+    while True:
+        search_term = title
+        if title is None or manual:
+            default_text = ""
+            if title:
+                query_text = f"Title: {title}\nFile: {filename}\nEnter search criteria:"
+                default_text = title
+            else:
+                query_text = f"No title for\n{filename}\nEnter search criteria:"
+                default_text = guess_title(filename)
+            maybe = input_dialog(
+                title="Search",
+                text=query_text,
+                ok_text="Enter",
+                cancel_text="Skip",
+                default=default_text,
+            ).run()
+            if maybe is None:
+                return None
+            search_term = maybe
+
+        results = cached_tv_search(search_term)
+
+        if not results:
+            if title and manual:
+                return None
+            logging.warning("Title did not find results, try manual")
+            manual = True
+            continue
+
+        # Fetch every result's details at once, each is its own round-trip to TMDB
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            infos = list(pool.map(lambda s: cached_tv_info(s["id"]), results))
+
+        shows = [build_tv_show(s["id"], s["name"], info) for s, info in zip(results, infos)]
+
+        result = paged_radiolist_dialog(
+            title="Best Match",
+            text=str(filename),
+            values=[(x, str(x)) for x in shows],
+            extra=[(NONEABOVE, "None of the above")],
+        )
+
+        if result is NONEABOVE:
+            manual = True
+            continue
+        if result is not None:
+            remember_show(key, result)
+        return result
 
 
 def identify_tv_season(filename: Path, tv_show: TVShow) -> Optional[TVSeason]:
     NONEABOVE = object()
-    season = radiolist_dialog(
+    season = paged_radiolist_dialog(
         title="Which season?",
         text=f"Filename: {filename}\nShow: {tv_show.name}",
-        values=[(x, str(x)) for x in tv_show.seasons] + [(NONEABOVE, "None of the above")],
-    ).run()
+        values=[(x, str(x)) for x in tv_show.seasons],
+        extra=[(NONEABOVE, "None of the above")],
+    )
     if season is None or season is NONEABOVE:
         return None
     return season
 
 
-def select_episode(filename: Path, tv_show: TVShow, tv_season: TVSeason) -> Optional[TVEpisode]:
-    """Prompt the user to select an episode from a list fetched from TMDB."""
-    tmdb_season = tmdb.TV_Seasons(tv_show.tmdb_id, tv_season.season_number)
-    tmdb_season.info()
-    episodes = tmdb_season.episodes
-
-    tv_episodes = [
+@functools.lru_cache(maxsize=128)
+def season_episodes(show_id: int, season_number: int) -> Tuple[TVEpisode, ...]:
+    """Episodes of a season, built once per season for the whole run"""
+    episodes = cached_season_info(show_id, season_number)["episodes"]
+    return tuple(
         TVEpisode(
             name=ep['name'],
             episode_number=ep['episode_number'],
@@ -155,25 +229,53 @@ def select_episode(filename: Path, tv_show: TVShow, tv_season: TVSeason) -> Opti
             overview=ep['overview'],
             tmdb_id=ep['id']
         ) for ep in episodes
-    ]
+    )
+
+
+def select_episode(filename: Path, tv_show: TVShow, tv_season: TVSeason) -> Optional[TVEpisode]:
+    """Prompt the user to select an episode from a list fetched from TMDB."""
+    tv_episodes = {
+        ep.episode_number: ep
+        for ep in season_episodes(tv_show.tmdb_id, tv_season.season_number)
+    }
 
     NONEABOVE = object()
-    result = radiolist_dialog(
+    result = paged_radiolist_dialog(
         title=f"Select Episode for {tv_show.name} Season {tv_season.season_number}",
         text=f"Filename: {filename}\nSeason {tv_season.season_number} Episodes",
-        values=[(ep.episode_number, str(ep)) for ep in tv_episodes] + [(NONEABOVE, "None of the above")],
-    ).run()
+        values=[(num, str(ep)) for num, ep in tv_episodes.items()],
+        extra=[(NONEABOVE, "None of the above")],
+    )
 
     if result is NONEABOVE or result is None:
         return None
 
-    return next(ep for ep in tv_episodes if ep.episode_number == result)
+    return tv_episodes[result]
+
+
+SUPPORTED_SUFFIXES = (".mkv", ".mp4")
+
+# Warms the load_mkv cache in the background
+_prefetch_pool = ThreadPoolExecutor(max_workers=1)
+# Runs renames one at a time, in the order they were approved
+_rename_pool = ThreadPoolExecutor(max_workers=1)
+
+
+def _report_moves(moves: List[Tuple[Path, Future]], wait: bool = False) -> List[Tuple[Path, Future]]:
+    """Log failed moves from the main thread, returns the ones still running.
+    A failed move is only logged, the rest of the directory is still processed.
+    """
+    pending = []
+    for src, move in moves:
+        if not wait and not move.done():
+            pending.append((src, move))
+        elif move.exception() is not None:
+            logging.error(f"Move failed for {src}: {move.exception()}")
+    return pending
 
 
 def get_supported_files(directory: Path) -> List[Path]:
-    return [
-        x for x in itertools.chain(directory.glob("*.mkv"), directory.glob("*.mp4"))
-    ]
+    return scan_files(directory, SUPPORTED_SUFFIXES, include_hidden=True)
 
 
 def process_tv_dir(
@@ -193,74 +295,85 @@ def process_tv_dir(
     if not input_directory.is_dir():
         logging.warning(f"Skipping non-directory: {input_directory}")
     tv_season = None
-    file_actions = []
     episode_num = start_episode
     episodes = sorted(get_supported_files(input_directory))
     approve_all = False
-    for filename in episodes:
-        if not filename.is_file():
-            continue
-        file = MKVFile(filename)
-        if tv_show is None:
-            tv_show = identify_tv_show(filename, file.title, False)
-
-        if tv_show is not None and (tv_season is None or mixed):
-            tv_season = identify_tv_season(filename, tv_show)
-        if tv_show is None or tv_season is None:
-            logging.warning("Failed to identify TV show or season")
-            continue
-
-        if mixed:
-            episode = select_episode(filename, tv_show, tv_season)
-            if episode is None:
-                return None
-            episode_num = episode.episode_number
-
-        # Get the episode number from the output directory now that we have an
-        # idea of where it's going
-        if episode_num == 0:
-            maybe_dst = output_dir / out_format.format(
+    moves = []
+    try:
+        for i, filename in enumerate(episodes):
+            if tv_show is None:
+                # While the user searches, identify the next file in case this one gets skipped
+                if i + 1 < len(episodes):
+                    _prefetch_pool.submit(load_mkv, episodes[i + 1])
+                tv_show = identify_tv_show(filename, load_mkv(filename).title, False)
+
+            if tv_show is not None and (tv_season is None or mixed):
+                tv_season = identify_tv_season(filename, tv_show)
+            if tv_show is None or tv_season is None:
+                logging.warning("Failed to identify TV show or season")
+                continue
+
+            if mixed:
+                episode = select_episode(filename, tv_show, tv_season)
+                if episode is None:
+                    return None
+                episode_num = episode.episode_number
+
+            fields = dict(
                 name=tv_show.name,
                 first_year=tv_show.first_year,
                 tmdb_id=tv_show.tmdb_id,
                 season_num=tv_season.season_number,
-                episode_num=0,
                 ext=filename.suffix[1:],  # we don't want the "period"
             )
-            episode_num = len(get_supported_files(maybe_dst.parent)) + 1
-            logging.info(f"Starting with episode {episode_num:02}")
-
-        dst = output_dir / out_format.format(
-            name=tv_show.name,
-            first_year=tv_show.first_year,
-            tmdb_id=tv_show.tmdb_id,
-            season_num=tv_season.season_number,
-            episode_num=episode_num,
-            ext=filename.suffix[1:],  # we don't want the "period"
-        )
 
-        if approve_all:
-            approved = True
-        else:
-            approved = button_dialog(
-                title=f"{tv_show.name} S{tv_season.season_number:02}E{episode_num:02}",
-                text=f"src: {filename}\ndst: {dst}" + (" (exists)" if dst.exists() else ""),
-                buttons=[("Yes", True), ("Yes to All", "all"), ("Skip", None), ("Delete", False)],
-            ).run()
-
-            if approved == "all":
-                approve_all = True
-                approved = True
+            # Get the episode number from the output directory now that we have an
+            # idea of where it's going
+            if episode_num == 0:
+                maybe_dst = output_dir / out_format.format(
+                    episode_num=0,
+                    **fields,
+                )
+                episode_num = count_files(maybe_dst.parent, SUPPORTED_SUFFIXES) + 1
+                logging.info(f"Starting with episode {episode_num:02}")
 
-        episode_num += 1
-        if approved is None:
-            continue
-        if approved:
-            rename_file(
-                ProcessedTvFile(src=filename, dst=dst, approved=True, show=tv_show),
-                dry_run=dry_run,
+            dst = output_dir / out_format.format(
+                episode_num=episode_num,
+                **fields,
             )
 
+            # Report finished moves now, before a dialog covers the screen again
+            moves = _report_moves(moves)
+            if approve_all:
+                approved = True
+            else:
+                approved = button_dialog(
+                    title=f"{tv_show.name} S{tv_season.season_number:02}E{episode_num:02}",
+                    text=f"src: {filename}\ndst: {dst}" + (" (exists)" if dst.exists() else ""),
+                    buttons=[("Yes", True), ("Yes to All", "all"), ("Skip", None), ("Delete", False)],
+                ).run()
+
+                if approved == "all":
+                    approve_all = True
+                    approved = True
+
+            episode_num += 1
+            if approved is None:
+                continue
+            if approved:
+                # Log here rather than in the worker so the line doesn't land on a dialog
+                logging.info(f"mv {filename} -> {dst}")
+                if not dry_run:
+                    # Move in the background so a slow cross-device copy doesn't hold up the next prompt
+                    move = _rename_pool.submit(
+                        move_file,
+                        ProcessedTvFile(src=filename, dst=dst, approved=True, show=tv_show),
+                    )
+                    moves.append((filename, move))
+    finally:
+        # Wait for every queued move, failures are logged so later directories still run
+        _report_moves(moves, wait=True)
+
     try:
         input_directory.rmdir()
     except Exception:
@@ -0,0 +1,111 @@
+import functools
+import json
+import sqlite3
+import time
+from contextlib import closing
+from typing import Any, Callable, List, Optional
+
+import tmdbsimple as tmdb
+
+from .common import cache_dir
+
+# Responses older than this are fetched again
+TTL = 7 * 24 * 60 * 60
+
+
+def _connect() -> sqlite3.Connection:
+    path = cache_dir() / "tmdb.sqlite"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search"
+        " (query TEXT, lang TEXT, ts INTEGER, json BLOB, PRIMARY KEY(query, lang))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS response (key TEXT PRIMARY KEY, ts INTEGER, json BLOB)"
+    )
+    return conn
+
+
+def _cached_response(key: str, fetch: Callable[[], Any]) -> Any:
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT json FROM response WHERE key=? AND ts > ?",
+            (key, int(time.time()) - TTL),
+        ).fetchone()
+    if row is not None:
+        return json.loads(row[0])
+
+    value = fetch()
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO response VALUES (?, ?, ?)",
+            (key, int(time.time()), json.dumps(value)),
+        )
+    return value
+
+
+def cached_search(query: str, lang: Optional[str] = None) -> List[dict]:
+    """Movie search results for a query, served from disk while younger than TTL"""
+    lang = lang or ""
+    with closing(_connect()) as conn:
+        row = conn.execute(
+            "SELECT json FROM search WHERE query=? AND lang=? AND ts > ?",
+            (query, lang, int(time.time()) - TTL),
+        ).fetchone()
+    if row is not None:
+        return json.loads(row[0])
+
+    search = tmdb.Search()
+    search.movie(query=query)
+    with closing(_connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?)",
+            (query, lang, int(time.time()), json.dumps(search.results)),
+        )
+    return search.results
+
+
+# The TV helpers also keep an in-process copy, process_tv_dir asks for the same
+# show and season once per file
+
+
+@functools.lru_cache(maxsize=256)
+def cached_tv_search(query: str) -> List[dict]:
+    """TV search results for a query"""
+
+    def fetch():
+        search = tmdb.Search()
+        search.tv(query=query)
+        return search.results
+
+    return _cached_response(f"search/tv?query={query}", fetch)
+
+
+_TV_INFO_KEYS = ("first_air_date", "last_air_date", "number_of_episodes", "seasons")
+_SEASON_KEYS = ("name", "season_number", "episode_count", "air_date", "id")
+
+
+def _project(data: dict, keys) -> dict:
+    return {k: data[k] for k in keys if k in data}
+
+
+@functools.lru_cache(maxsize=256)
+def cached_tv_info(tmdb_id: int) -> dict:
+    """Details of a TV show, trimmed to the fields identify_tv_show reads"""
+
+    def fetch():
+        info = _project(tmdb.TV(tmdb_id).info(), _TV_INFO_KEYS)
+        info["seasons"] = [_project(x, _SEASON_KEYS) for x in info.get("seasons", [])]
+        return info
+
+    return _cached_response(f"tv/{tmdb_id}", fetch)
+
+
+@functools.lru_cache(maxsize=256)
+def cached_season_info(tmdb_id: int, season_number: int) -> dict:
+    """Details of one season of a TV show, including its episodes"""
+    return _cached_response(
+        f"tv/{tmdb_id}/season/{season_number}",
+        lambda: tmdb.TV_Seasons(tmdb_id, season_number).info(),
+    )